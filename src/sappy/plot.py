@@ -1,6 +1,5 @@
 """Plotting functions for ``sappy``."""
 import numpy as np
-import seaborn as sns
 import matplotlib.patches as p
 import matplotlib.pyplot as plt
 
@@ -22,10 +21,16 @@ def spectral_derivs(spec_der, contrast=0.1, ax=None, freq_range=None,
     """
     if spec_der.ndim == 1:
         spec_der = songfeatures.spectral_derivs(spec_der, freq_range, ov_params)
-    ax = sns.heatmap(spec_der.T, yticklabels=100, xticklabels=100,
-                     vmin=-contrast, vmax=contrast, ax=ax, cmap='Greys',
-                     cbar=False)
-    ax.invert_yaxis()
+    # float32 is plenty for display and halves the memory of the image
+    spec_der = np.asarray(spec_der, dtype=np.float32)
+    if ax is None:
+        _, ax = plt.subplots()
+    ax.imshow(spec_der.T, origin='lower', aspect='auto',
+              vmin=-contrast, vmax=contrast, cmap='Greys',
+              interpolation='nearest',
+              extent=(0, spec_der.shape[0], 0, spec_der.shape[1]))
+    ax.set_xticks(np.arange(0, spec_der.shape[0], 100))
+    ax.set_yticks(np.arange(0, spec_der.shape[1], 100))
     return ax
 
 
@@ -34,6 +39,7 @@ def features_over_spec(data, ax, freq_range=256, **plot_params):
 
     The data are first normalized, then rescaled to fit the ylim of the axis.
     """
+    data = np.asarray(data, dtype=np.float32)
     # Normalize the data so that they fit in the graph
     ndata = data / (np.nanmax(data) - np.nanmin(data))
     # We plot -ndata because the yaxis is inverted (see ``sappy.plot.spectral_derivs``)
@@ -45,19 +51,30 @@ def features_over_spec(data, ax, freq_range=256, **plot_params):
 
 
 def similarity(sim, song, refsong):
-    """Plot the result of ``sappy.similarity``."""
+    """Plot the result of ``sappy.similarity``.
+
+    The spectral derivatives are reused from `sim` if it was computed with
+    `keep_spec_der=True`, otherwise they are computed from the songs.
+    """
     fig, ax = plt.subplots(2, 2, figsize=(13, 13),
                            gridspec_kw={'width_ratios': [1, 4],
                                         'height_ratios': [1, 4]})
     ax[0, 0].axis('off')
-    sds = songfeatures.spectral_derivs(song)
-    sdr = songfeatures.spectral_derivs(refsong)
+    # Reuse the spectral derivatives computed by ``sappy.similarity``
+    sds = sim.get('spec_der_song')
+    if sds is None:
+        sds = songfeatures.spectral_derivs(song)
+    sdr = sim.get('spec_der_ref')
+    if sdr is None:
+        sdr = songfeatures.spectral_derivs(refsong)
     ax[0, 1] = spectral_derivs(sds, 0.05, ax[0, 1])
     ax[0, 1].set_title('Song')
     ax[1, 0] = spectral_derivs(np.flip(sdr.T, 1), 0.05, ax[1, 0])
     ax[1, 0].set_title('Reference Song')
-    ax[1, 1] = sns.heatmap(sim['glob_matrix'], ax=ax[1, 1], cbar=False,
-                           vmin=0, vmax=1)
+    ax[1, 1].imshow(sim['glob_matrix'], vmin=0, vmax=1, aspect='auto',
+                    origin='upper', interpolation='nearest',
+                    extent=(0, sim['glob_matrix'].shape[1],
+                            sim['glob_matrix'].shape[0], 0))
     for section in sim['sections']:
         xy = (section['beg'][0],
               sim['glob_matrix'].shape[1] - section['end'][1])
@@ -8,28 +8,40 @@
 #                                                               #
 #################################################################
 import numpy as np
+from numba import njit, prange
 from scipy.stats import norm
 
-from .songfeatures import all_song_features, song_amplitude
-from .utils import calc_dist_features, normalize_features, get_windows
+from .songfeatures import all_song_features
+from .utils import calc_dist_features, normalize_features
 
 
-def identify_sections(similarity):
+@njit(cache=True, boundscheck=False)
+def _identify_sections_nb(similarity, seeds, row_dead, col_dead, out_boxes,
+                          locvisited, stack, stamp):
     """
-    Identify the blocks of similarity in a song.
+    Flood-fill kernel of `identify_sections`.
 
-    This algorithm is written in step 7 of the appendix of Tchernichovski 2000.
+    Write the `(bi, bj, ei, ej)` boxes of the sections found from `seeds`
+    into `out_boxes` and return the number of sections written, along with
+    the last stamp used. The rows and columns flagged in `row_dead` and
+    `col_dead` are treated as zeros. `similarity` is the flattened (C order)
+    similarity matrix, element `(i, j)` being at index `i*m + j`.
+    `locvisited` is an int32 array and `stack` an int64 array, both of the
+    size of `similarity`. The stamps of this call start after `stamp`, so
+    `locvisited` can be reused from a previous call without being cleared,
+    as long as no element of it is greater than `stamp`.
     """
-    directions = [(1, 0), (0, 1), (1, 1)]
-    sections = []
-    visited = np.full(similarity.shape, False, dtype=bool)
-    for i, j in sorted(zip(*np.where(similarity > 0))):
-        if visited[i, j]:
-            continue
-        locvisited = np.full(similarity.shape, False, dtype=bool)
+    n = row_dead.size
+    m = col_dead.size
+    n_sections = 0
+    first_stamp = stamp + 1
+    for k in range(seeds.shape[0]):
+        i = seeds[k, 0]
+        j = seeds[k, 1]
         # `locvisited` represents the element of the matrix visited
-        # during the creation of one specific section
-        # locvisited is recreated every new section because one element
+        # during the creation of one specific section, they are marked with
+        # the `stamp` of the section. The flooding of a new section does not
+        # care about the stamps of the previous ones because one element
         # can be in two different sections. Though, if an element is
         # already in a section, any section with this element in the upper
         # left corner will be a subsection of the sections containing
@@ -43,78 +55,235 @@ def identify_sections(similarity):
         #  . . | . . . . | .
         #  . . + - - - - + .
         # The star can be both in the big section or the small section.
-        # Thus they need their own locvisited for the flooding.
+        # Thus they need their own stamp for the flooding.
         # But the section starting from the star will necesserarly be
         # less good than any other section which started before.
         # Therefore it is no use to take the star as the `beg` coordinate
         # of a section. And every element which is already in a section
-        # does not need to be taken as `beg`.
+        # (i.e. which has any stamp of this call) does not need to be
+        # taken as `beg`.
         # if it is not clear, just send me a mail ecoffet.paul@gmail.com
-        locvisited[i, j] = True
-        beg = (i, j)
-        end = (i, j)
-        flood_stack = [beg]
+        idx = i * m + j
+        if similarity[idx] <= 0 or locvisited[idx] >= first_stamp \
+                or row_dead[i] or col_dead[j]:
+            continue
+        stamp += 1
+        locvisited[idx] = stamp
+        ei = i
+        ej = j
+        stack[0] = idx
+        head = 1
         # use a flood algorithm to find the boundaries of the section
         # as stated in step 7 of Tchernichovski 2000
-        while flood_stack:
-            cur = flood_stack.pop()
-            locvisited[cur] = True
+        while head > 0:
+            head -= 1
+            idx = stack[head]
+            ci = idx // m
+            cj = idx - ci * m
             # extend the boundaries of the section
-            end = (max(end[0], cur[0]), max(end[1], cur[1]))
-            for diri, dirj in directions:
-                new_coord = (cur[0] + diri, cur[1] + dirj)
-                if new_coord[0] < similarity.shape[0] \
-                        and new_coord[1] < similarity.shape[1] \
-                        and similarity[new_coord] > 0 \
-                        and not locvisited[new_coord]:
-                    locvisited[new_coord] = True
-                    flood_stack.append((new_coord))
-        if end[0] - beg[0] > 4 and end[1] - beg[1] > 4:
-            sections.append({'beg': beg, 'end': end})
-        # If it is already part of a section, it is no use to
-        # start exploring from this point, so we put locvisited as
-        # visited
-        visited = visited | locvisited
-    return sections
+            if ci > ei:
+                ei = ci
+            if cj > ej:
+                ej = cj
+            # explore the directions (1, 0), (0, 1) and (1, 1), which are
+            # at the flat offsets m, 1 and m + 1
+            down = ci + 1 < n and not row_dead[ci + 1]
+            right = cj + 1 < m and not col_dead[cj + 1]
+            if down:
+                nidx = idx + m
+                if locvisited[nidx] != stamp and similarity[nidx] > 0:
+                    locvisited[nidx] = stamp
+                    stack[head] = nidx
+                    head += 1
+            if right:
+                nidx = idx + 1
+                if locvisited[nidx] != stamp and similarity[nidx] > 0:
+                    locvisited[nidx] = stamp
+                    stack[head] = nidx
+                    head += 1
+            if down and right:
+                nidx = idx + m + 1
+                if locvisited[nidx] != stamp and similarity[nidx] > 0:
+                    locvisited[nidx] = stamp
+                    stack[head] = nidx
+                    head += 1
+        if ei - i > 4 and ej - j > 4:
+            out_boxes[n_sections, 0] = i
+            out_boxes[n_sections, 1] = j
+            out_boxes[n_sections, 2] = ei
+            out_boxes[n_sections, 3] = ej
+            n_sections += 1
+    return n_sections, stamp
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _score_sections_nb(similarity, bi, bj, ei, ej, out):
+    """
+    Sum, for each section, the max of `similarity` over each column.
+
+    The section `k` spans rows `bi[k]` to `ei[k]` and columns `bj[k]` to
+    `ej[k]` (inclusive). The scores are written into `out`.
+    """
+    for k in prange(bi.size):
+        s = 0.0
+        for jj in range(bj[k], ej[k] + 1):
+            col_max = 0.0
+            for ii in range(bi[k], ei[k] + 1):
+                v = similarity[ii, jj]
+                if v > col_max:
+                    col_max = v
+            s += col_max
+        out[k] = s
+
+
+def _find_sections(similarity, seeds, row_dead, col_dead, work=None):
+    """
+    Return the `(n_sections, 4)` array of the `(bi, bj, ei, ej)` boxes.
+
+    `seeds` are the candidate `beg` coordinates in lexicographic order,
+    the rows and columns flagged in `row_dead` and `col_dead` are ignored.
+    `work` is a dict holding the flood-fill buffers. Giving the same dict
+    to successive calls on the same matrix reuses them instead of
+    allocating and clearing new ones every time.
+    """
+    if work is None:
+        work = dict()
+    if 'locvisited' not in work:
+        work['locvisited'] = np.zeros(similarity.size, dtype=np.int32)
+        work['stack'] = np.empty(similarity.size, dtype=np.int64)
+        work['stamp'] = 0
+    if work['stamp'] > np.iinfo(np.int32).max - seeds.shape[0]:
+        # Clear the stamps rather than let them overflow
+        work['locvisited'][:] = 0
+        work['stamp'] = 0
+    out_boxes = np.empty((seeds.shape[0], 4), dtype=np.int32)
+    n_sections, work['stamp'] = _identify_sections_nb(
+        np.ravel(similarity), seeds, row_dead, col_dead, out_boxes,
+        work['locvisited'], work['stack'], work['stamp'])
+    return out_boxes[:n_sections]
+
+
+def identify_sections(similarity, seeds=None):
+    """
+    Identify the blocks of similarity in a song.
+
+    This algorithm is written in step 7 of the appendix of Tchernichovski 2000.
 
+    seeds - The `(i, j)` coordinates the sections may start from, as an
+            array of shape `(N, 2)` in lexicographic order. If None, all the
+            positive elements of `similarity` are used. The seeds which are
+            not positive anymore are skipped, so that the same seeds can be
+            reused while parts of `similarity` are zeroed. Seeds which are
+            not sorted give different sections, as a section is started from
+            every seed not already in a previous section.
+    """
+    if seeds is None:
+        # `argwhere` gives the positive elements in lexicographic order
+        seeds = np.argwhere(similarity > 0)
+    seeds = np.asarray(seeds)
+    if seeds.size == 0:
+        seeds = seeds.reshape(0, 2).astype(np.int32)
+    if seeds.ndim != 2 or seeds.shape[1] != 2 \
+            or not np.issubdtype(seeds.dtype, np.integer):
+        raise ValueError('`seeds` must be an integer array of shape (N, 2).')
+    if np.any(seeds < 0) or np.any(seeds >= similarity.shape):
+        raise ValueError('`seeds` must be coordinates inside `similarity`.')
+    seeds = seeds.astype(np.int32)
+    row_dead = np.zeros(similarity.shape[0], dtype=bool)
+    col_dead = np.zeros(similarity.shape[1], dtype=bool)
+    boxes = _find_sections(similarity, seeds, row_dead, col_dead)
+    return [{'beg': (bi, bj), 'end': (ei, ej)}
+            for bi, bj, ei, ej in boxes.tolist()]
+
+
+# Number of diagonals of L2 handled by one task of `_compute_G2_nb`
+_G2_BAND = 256
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _compute_G2_nb(L2, T):
+    """
+    Compute the G² matrix from the L² matrix (step 4 of Tchernichovski 2000).
 
-def _compute_G2(song_win, refsong_win, L2, T):
-    fast = True
-    if fast:
-        G2 = np.zeros((song_win.shape[0], refsong_win.shape[0]))  # G2 = G²
-        sumG2 = np.zeros((song_win.shape[0], refsong_win.shape[0]))
-        for i in range(song_win.shape[0]):
-            for j in range(refsong_win.shape[0]):
-                if i <= T or j <= T:
-                    imin = max(i - T//2, 0)
-                    jmin = max(j - T//2, 0)
-                    G2[i, j] = np.mean(np.diag(L2[imin:i+T//2, jmin:j+T//2]))
-                    sumG2[i, j] = np.sum(np.diag(L2[imin:i+T//2, jmin:j+T//2]))
-                elif i < song_win.shape[0] - T*2 \
-                        and j < refsong_win.shape[0] - T*2:
-                    sumG2[i, j] = (sumG2[i - 1, j - 1]
-                                   - L2[(i - 1) - T//2, (j - 1) - T//2]
-                                   + L2[i + (T//2)-1, j + (T//2)-1])
-                    G2[i, j] = sumG2[i, j] / T
+    `G2[i, j]` is the mean of `L2` along the diagonal going through `(i, j)`,
+    over the `T` elements centered on `(i, j)`. Near the boundaries, the
+    window is truncated and the mean is taken over the remaining elements.
+    The window sums are updated with one addition and one subtraction per
+    element, so the cost does not depend on `T`.
+    """
+    n, m = L2.shape
+    G2 = np.zeros((n, m))  # G2 = G²
+    half = T // 2
+    n_bands = (n + m - 1 + _G2_BAND - 1) // _G2_BAND
+    # The diagonals are split in bands which are independent, each band
+    # has its own window sums.
+    for b in prange(n_bands):
+        # the band holds the diagonals `d0 <= j - i < d1`
+        d0 = b * _G2_BAND - (n - 1)
+        d1 = min(d0 + _G2_BAND, m)
+        # window sum of each diagonal of the band, indexed by `j - i - d0`
+        running = np.zeros(d1 - d0)
+        # go through the band row by row so that every access is contiguous
+        for i in range(max(0, -d1 + 1), min(n, m - d0)):
+            for j in range(max(i + d0, 0), min(i + d1, m)):
+                # position of (i, j) along its diagonal, and diagonal length
+                t = min(i, j)
+                length = min(n - i, m - j) + t
+                if t == 0:
+                    # first element of the diagonal, fill its window
+                    s = 0.0
+                    for k in range(min(half, length)):
+                        s += L2[i + k, j + k]
                 else:
-                    imax = min(i + T//2, song_win.shape[0])
-                    jmax = min(j + T//2, refsong_win.shape[0])
-                    G2[i, j] = np.mean(np.diag(L2[i - T//2:imax, j - T//2:jmax]))
-    else:
-        G2 = np.zeros((song_win.shape[0], refsong_win.shape[0]))
-        for i in range(song_win.shape[0]):
-            for j in range(refsong_win.shape[0]):
-                imin = max(0, (i-T//2))
-                imax = min(G2.shape[0], (i+T//2))
-                jmin = max(0, (j-T//2))
-                jmax = min(G2.shape[1], (j+T//2))
-                G2[i, j] = np.mean(np.diag(L2[imin:imax, jmin:jmax]))
+                    # slide the window of the previous element of the diagonal
+                    s = running[j - i - d0]
+                    if t + half - 1 < length:
+                        s += L2[i + half - 1, j + half - 1]
+                    if t - half - 1 >= 0:
+                        s -= L2[i - half - 1, j - half - 1]
+                running[j - i - d0] = s
+                G2[i, j] = s / (min(t + half, length) - max(t - half, 0))
     return G2
 
 
+def _select_sections(similarity, len_refsong):
+    """
+    Select the similar sections one by one, the best first.
+
+    After each selection, the rows and columns of the chosen section are
+    excluded, and the sections are searched again in what remains.
+    """
+    sections = []
+    # The rows and columns of the sections already found are masked out
+    # of the search instead of being zeroed in a copy of `similarity`.
+    row_dead = np.zeros(similarity.shape[0], dtype=bool)
+    col_dead = np.zeros(similarity.shape[1], dtype=bool)
+    seeds = np.argwhere(similarity > 0).astype(np.int32)
+    work = dict()
+    while True:
+        boxes = _find_sections(similarity, seeds, row_dead, col_dead, work)
+        if len(boxes) == 0:
+            break  # Exit the loop if there is no more sections
+        # Score the sections from contiguous arrays of their coordinates
+        bi, bj, ei, ej = (np.ascontiguousarray(col) for col in boxes.T)
+        scores = np.empty(len(boxes))
+        _score_sections_nb(similarity, bi, bj, ei, ej, scores)
+        P = scores / len_refsong
+        # Among equal scores, keep the last section found
+        k = len(P) - 1 - np.argmax(P[::-1])
+        best = {'beg': (int(bi[k]), int(bj[k])),
+                'end': (int(ei[k]), int(ej[k])),
+                'P': P[k]}
+        row_dead[best['beg'][0]:best['end'][0]+1] = True
+        col_dead[best['beg'][1]:best['end'][1]+1] = True
+        seeds = seeds[~(row_dead[seeds[:, 0]] | col_dead[seeds[:, 1]])]
+        sections.append(best)
+    return sections
+
+
 def similarity(song, refsong, threshold=0.01, ignore_silence=True,
                T=70, samplerate=44100, silence_song_th=None,
-               silence_ref_th=None):
+               silence_ref_th=None, keep_spec_der=False):
     """
     Compute similarity between two songs.
 
@@ -131,6 +300,8 @@ def similarity(song, refsong, threshold=0.01, ignore_silence=True,
         of song. With 70 windows, spaced by 40 samples, and at samplerate of
         44100, the windows cover 63ms. It is also the default value used by
         Sound Analysis Toolbox.
+    keep_spec_der - Should the spectral derivatives of the songs be returned,
+                    for ``sappy.plot.similarity`` to reuse them.
 
 
     Return a dict with the keys :
@@ -138,6 +309,10 @@ def similarity(song, refsong, threshold=0.01, ignore_silence=True,
     sim_matrix - a 2D-array of the similarity probability
     glob_matrix - a 2D-array of the global similarity probability
     sections - The sections that are similar and their scores
+    spec_der_song - The spectral derivatives of `song`, only if
+                    `keep_spec_der` is True
+    spec_der_ref - The spectral derivatives of `refsong`, only if
+                   `keep_spec_der` is True
 
     Compute the similarity between the song `song` and a reference song
     `refsong` using the method described in Tchernichovski, Nottebohm,
@@ -153,15 +328,20 @@ def similarity(song, refsong, threshold=0.01, ignore_silence=True,
     P. P. (2000). A procedure for an automated measurement of song similarity.
     Animal Behaviour, 59(6), 1167–1176. https://doi.org/10.1006/anbe.1999.1416
     """
-    song_win = get_windows(song)
-    refsong_win = get_windows(refsong)
     #########################################################################
     # Compute sound features and scale them (step 2 of Tchernichovski 2000) #
     #########################################################################
-    song_features = all_song_features(song, samplerate)
-    del song_features['amplitude']
-    refsong_features = all_song_features(refsong, samplerate)
-    del refsong_features['amplitude']
+    # The spectral derivatives come from the same FFTs, they can be kept
+    # for ``sappy.plot.similarity``. The amplitude is not used in the
+    # distance but is kept to find the silences.
+    song_features = all_song_features(song, samplerate,
+                                      spec_der=keep_spec_der)
+    spec_der_song = song_features.pop('spec_der', None)
+    amp_song = song_features.pop('amplitude')
+    refsong_features = all_song_features(refsong, samplerate,
+                                         spec_der=keep_spec_der)
+    spec_der_ref = refsong_features.pop('spec_der', None)
+    amp_refsong = refsong_features.pop('amplitude')
     adj_song_features = normalize_features(song_features)
     adj_refsong_features = normalize_features(refsong_features)
     #################################
@@ -169,9 +349,14 @@ def similarity(song, refsong, threshold=0.01, ignore_silence=True,
     #################################
     # L2 = L²
     local_dists = calc_dist_features(adj_song_features, adj_refsong_features)
-    L2 = np.mean(
-        np.array([local_dists[fname] for fname in local_dists.keys()]),
-        axis=0)
+    # Running mean over the features, to avoid stacking them in a 3D array
+    dists = iter(local_dists.values())
+    L2 = next(dists).astype(np.float64, copy=True)
+    count = 1
+    for dist in dists:
+        L2 += dist
+        count += 1
+    L2 /= count
     # avoid boundaries effect
     # maxL2 = np.max(L2)
     # L2[:T//2, :] = maxL2
@@ -183,7 +368,7 @@ def similarity(song, refsong, threshold=0.01, ignore_silence=True,
     # Compute G Matrix (step 4) #
     #############################
 
-    G2 = _compute_G2(song_win, refsong_win, L2, T)
+    G2 = _compute_G2_nb(L2, T)
 
     ####################################################################
     # Compute P value and reject similarity hypothesis (steps 5 and 6) #
@@ -196,8 +381,6 @@ def similarity(song, refsong, threshold=0.01, ignore_silence=True,
     # Identify similarity sections (step 7) #
     #########################################
     if ignore_silence:
-        amp_song = song_amplitude(song)
-        amp_refsong = song_amplitude(refsong)
         # Do not take into account all sounds that are in the first 20
         # percentile. They are very likely to be silent.
         if silence_song_th is None:
@@ -205,26 +388,12 @@ def similarity(song, refsong, threshold=0.01, ignore_silence=True,
         similarity[amp_song < silence_song_th, :] = 0
         if silence_ref_th is None:
             silence_ref_th = np.percentile(amp_refsong, 15)
-        similarity[:, amp_refsong < silence_ref_th] = 0
-        len_refsong = similarity.shape[1] - np.sum(amp_refsong < silence_ref_th)
+        silent_ref = amp_refsong < silence_ref_th
+        similarity[:, silent_ref] = 0
+        len_refsong = similarity.shape[1] - np.count_nonzero(silent_ref)
     else:
         len_refsong = similarity.shape[1]
-    sections = []
-    wsimilarity = np.copy(similarity)
-    while True:
-        cur_sections = identify_sections(wsimilarity)
-        if len(cur_sections) == 0:
-            break  # Exit the loop if there is no more sections
-        for section in cur_sections:
-            beg, end = section['beg'], section['end']
-            section['P'] = (np.sum(np.max(similarity[beg[0]:end[0]+1,
-                                                     beg[1]:end[1]+1], axis=0))
-                            / len_refsong)
-        cur_sections.sort(key=lambda x: x['P'])
-        best = cur_sections.pop()
-        wsimilarity[best['beg'][0]:best['end'][0]+1, :] = 0
-        wsimilarity[:, best['beg'][1]:best['end'][1]+1] = 0
-        sections.append(best)
+    sections = _select_sections(similarity, len_refsong)
     out = {'similarity': np.sum([section['P'] for section in sections]),
            'sim_matrix': similarity,
            'glob_matrix': glob,
@@ -232,6 +401,9 @@ def similarity(song, refsong, threshold=0.01, ignore_silence=True,
            'G2': G2,
            'L2': L2
            }
+    if keep_spec_der:
+        out['spec_der_song'] = spec_der_song
+        out['spec_der_ref'] = spec_der_ref
     return out
 
 
@@ -242,10 +414,8 @@ def p_val_err_local(x):
     See the notebook `Distrib` to understand the mean and std used.
     """
     assert np.all(x >= 0), 'Errors must be positive.'
-    p = np.zeros(x.shape)
-    for i in range(len(percentile_L)):
-        p[np.where(x > percentile_L[i])] = (i+1)/100
-    return p
+    # The number of percentiles strictly below `x` gives its p-value
+    return np.searchsorted(percentile_L, x, side='left') / 100
     # return norm.cdf(np.log(x + 0.01), 2.0893176665431645, 1.3921924227352549)
 
 
@@ -256,10 +426,8 @@ def p_val_err_global(x):
     The fit is done using 4 songs, it is available in the notebook `Distrib`
     """
     assert np.all(x >= 0), 'Errors must be positive.'
-    p = np.zeros(x.shape)
-    for i in range(len(percentile_G)):
-        p[np.where(x > percentile_G[i])] = (i+1)/100
-    return p
+    # The number of percentiles strictly below `x` gives its p-value
+    return np.searchsorted(percentile_G, x, side='left') / 100
 #    return norm.cdf(np.log(x + 0.01), 2.6191330043001892, 1.6034598153962765)
 
 
@@ -363,7 +531,9 @@ percentile_G = np.array(
     503.84382308117381,
     914.95721910297993,
     1643.9748972876507,
-    6301.0969631170328])
+    6301.0969631170328],
+   dtype=np.float32)
+percentile_G.setflags(write=False)
 
 
 percentile_L = np.array(
@@ -466,4 +636,6 @@ percentile_L = np.array(
     136.46957950931011,
     199.61077017914533,
     1462.2110958032815,
-    100790.20636471517])
+    100790.20636471517],
+   dtype=np.float32)
+percentile_L.setflags(write=False)
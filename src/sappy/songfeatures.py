@@ -261,17 +261,30 @@ def song_goodness(song, freq_range=None, fft_step=None, fft_size=None):
 
 def all_song_features(song, sr, pitch_method=None,
                       pitch_threshold=None, freq_range=None,
-                      fft_step=None, fft_size=None):
-    """Return all the song features in a `dict`."""
+                      fft_step=None, fft_size=None, spec_der=False):
+    """
+    Return all the song features in a `dict`.
+
+    If `spec_der` is True, the spectral derivatives of the song (see
+    `spectral_derivs`) are also computed from the same FFTs and returned
+    under the key `'spec_der'`.
+    """
     windows = get_windows(song, fft_step, fft_size)
     out = defaultdict(lambda: np.zeros(windows.shape[0], dtype=float))
     D = libtfr.mfft_dpss(windows.shape[1], 1.5, 2, windows.shape[1])
+    if spec_der:
+        der_range = 256 if freq_range is None else freq_range
+        out['spec_der'] = np.zeros((windows.shape[0], der_range))
     for i, window in enumerate(windows):
         Z = D.mtfft(window)
         P = D.mtpsd(window)
         out['goodness'][i] = goodness(window, freq_range, D=D.tapers)
         out['am'][i] = amplitude_modulation(Z, freq_range)
         out['fm'][i] = frequency_modulation(Z, freq_range)
+        if spec_der:
+            fm = out['fm'][i]
+            out['spec_der'][i, :] = (np.cos(fm) * time_der(Z, der_range)
+                                     + np.sin(fm) * freq_der(Z, der_range))
         out['amplitude'][i] = amplitude(P, freq_range)
         out['entropy'][i] = wiener_entropy(P, freq_range)
         if pitch_method == 'fft':
@@ -0,0 +1,160 @@
+import numpy as np
+import unittest
+from sappy.similarity import (_compute_G2_nb, _select_sections,
+                              identify_sections, p_val_err_global,
+                              p_val_err_local, percentile_G, percentile_L)
+
+
+def naive_G2(L2, T):
+    """Compute G2 element by element, with the window clipped to L2."""
+    G2 = np.zeros(L2.shape)
+    for i in range(L2.shape[0]):
+        for j in range(L2.shape[1]):
+            ks = [k for k in range(-(T//2), T//2)
+                  if 0 <= i + k < L2.shape[0] and 0 <= j + k < L2.shape[1]]
+            G2[i, j] = np.mean([L2[i + k, j + k] for k in ks])
+    return G2
+
+
+def naive_p_val(x, percentile):
+    """Compute the p-values with one mask per percentile."""
+    p = np.zeros(x.shape)
+    for i in range(len(percentile)):
+        p[np.where(x > percentile[i])] = (i+1)/100
+    return p
+
+
+def naive_select_sections(similarity, len_refsong):
+    """Select the sections by zeroing a copy and searching it again."""
+    sections = []
+    wsimilarity = np.copy(similarity)
+    while True:
+        cur_sections = identify_sections(wsimilarity)
+        if len(cur_sections) == 0:
+            break
+        for section in cur_sections:
+            beg, end = section['beg'], section['end']
+            section['P'] = (np.sum(np.max(similarity[beg[0]:end[0]+1,
+                                                     beg[1]:end[1]+1], axis=0))
+                            / len_refsong)
+        cur_sections.sort(key=lambda x: x['P'])
+        best = cur_sections.pop()
+        wsimilarity[best['beg'][0]:best['end'][0]+1, :] = 0
+        wsimilarity[:, best['beg'][1]:best['end'][1]+1] = 0
+        sections.append(best)
+    return sections
+
+
+class G2Test(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(20170203)
+
+    def test_G2_naive(self):
+        """
+        Test if G2 is the mean of L2 over the diagonal windows, for any T
+        """
+        for T in [10, 70, 128]:
+            L2 = self.rng.uniform(0, 50, size=(150, 170))
+            np.testing.assert_allclose(_compute_G2_nb(L2, T), naive_G2(L2, T))
+
+    def test_G2_boundaries(self):
+        """
+        Test if G2 is constant for a constant L2, up to the boundaries
+        """
+        L2 = np.full((120, 90), 3.)
+        np.testing.assert_allclose(_compute_G2_nb(L2, 70), L2)
+
+
+class SectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(20170203)
+
+    def test_sections_boxes(self):
+        """
+        Test if the sections of a hand-built matrix have the expected boxes
+        """
+        sim = np.zeros((20, 20))
+        # A block, the elements inside it do not start their own section
+        sim[12:19, 12:18] = 0.5
+        # Too small to be a section
+        sim[15:18, 0:3] = 0.5
+        # A corner starting at (0, 5), and a row starting at (1, 0) which
+        # floods through the corner: the element (1, 5) is in both sections
+        sim[0, 5:11] = 0.5
+        sim[0:9, 5] = 0.5
+        sim[1, 0:5] = 0.5
+        sections = identify_sections(sim)
+        self.assertEqual([(s['beg'], s['end']) for s in sections],
+                         [((0, 5), (8, 10)),
+                          ((1, 0), (8, 5)),
+                          ((12, 12), (18, 17))])
+
+    def test_sections_stale_seeds(self):
+        """
+        Test if the seeds of an earlier pass give the sections of a new scan
+        """
+        for _ in range(20):
+            sim = (self.rng.uniform(size=(60, 70))
+                   * (self.rng.uniform(size=(60, 70)) > 0.3))
+            seeds = np.argwhere(sim > 0)
+            sim[self.rng.randint(0, 60, size=5), :] = 0
+            sim[:, self.rng.randint(0, 70, size=5)] = 0
+            self.assertEqual(identify_sections(sim, seeds),
+                             identify_sections(sim))
+
+    def test_sections_bad_seeds(self):
+        """
+        Test if seeds outside the matrix or of the wrong shape are rejected
+        """
+        sim = np.ones((10, 10))
+        for seeds in [[(-1, 3)], [(50, 3)], [(3, 10)], [1, 2, 3],
+                      [(1.5, 2.)]]:
+            with self.assertRaises(ValueError):
+                identify_sections(sim, seeds)
+        self.assertEqual(identify_sections(sim, []), [])
+
+    def test_sections_selection(self):
+        """
+        Test if the masked selection finds the sections of a zeroed search
+        """
+        for _ in range(20):
+            sim = (self.rng.uniform(size=(60, 70))
+                   * (self.rng.uniform(size=(60, 70)) > 0.3))
+            expected = naive_select_sections(sim, sim.shape[1])
+            sections = _select_sections(sim, sim.shape[1])
+            self.assertEqual([(s['beg'], s['end']) for s in sections],
+                             [(s['beg'], s['end']) for s in expected])
+            np.testing.assert_allclose([s['P'] for s in sections],
+                                       [s['P'] for s in expected])
+
+    def test_sections_ties(self):
+        """
+        Test if the last section found is kept among equal scores
+        """
+        sim = np.zeros((20, 20))
+        sim[0:6, 10:16] = 0.5
+        sim[8:14, 0:6] = 0.5
+        sections = _select_sections(sim, sim.shape[1])
+        self.assertEqual([(s['beg'], s['end']) for s in sections],
+                         [((8, 0), (13, 5)), ((0, 10), (5, 15))])
+
+
+class PValTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(20170203)
+
+    def test_p_val_naive(self):
+        """
+        Test if the p-values match the per-percentile masks, on the
+        percentiles themselves too
+        """
+        for p_val, percentile in [(p_val_err_local, percentile_L),
+                                  (p_val_err_global, percentile_G)]:
+            x = np.concatenate((self.rng.lognormal(2, 2, size=1000),
+                                percentile.astype(np.float64),
+                                [0.]))
+            np.testing.assert_array_equal(p_val(x),
+                                          naive_p_val(x, percentile))